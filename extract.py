@@ -7,7 +7,9 @@ Authors: Rounak Meyur and Swapna Thorve
 Description: Functions to extract residence data
 """
 
+import io
 import os
+from collections.abc import Mapping
 import pandas as pd
 import numpy as np
 import networkx as nx
@@ -91,26 +93,13 @@ def GetCommunity(filename, com_index):
 def get_homes_ev_param(homes, dist, ev_homes, 
                        rating, capacity, initial, start, end):
     
-    # Change input data type of EV charger rating
-    if not isinstance(rating, dict):
-        rating = {h:rating for h in ev_homes}
-    
-    # Change input data type of EV charge capacity
-    if not isinstance(capacity, dict):
-        capacity = {h:capacity for h in ev_homes}
-        
-    # Change input data type of EV initial charge
-    if not isinstance(initial, dict):
-        initial = {h:initial for h in ev_homes}
-    
-    # Change input data type of EV charging start time
-    if not isinstance(start, dict):
-        start = {h:start for h in ev_homes}
-    
-    # Change input data type of EV charging end time
-    if not isinstance(end, dict):
-        end = {h:end for h in ev_homes}
+    # EV parameters are either scalars for all EV homes or dictionaries
+    # keyed by the residence
+    def param(value, h):
+        return value[h] if isinstance(value, dict) else value
     
+    # Set of EV homes for constant time membership check
+    ev_homes = set(ev_homes)
     
     # Get residences in the network
     res = [n for n in dist if dist.nodes[n]['label']=='H']
@@ -118,58 +107,143 @@ def get_homes_ev_param(homes, dist, ev_homes,
     # Get dictionary of homes with EV parameters
     home_params = {h:{} for h in res}
     for h in res:
-        home_params[h]["LOAD"] = [l for l in homes[h]]
+        home_params[h]["LOAD"] = list(homes[h])
         if h in ev_homes:
             home_params[h]["EV"] = {
-                "rating":rating[h],
-                "capacity":float(capacity[h]),
-                "initial":initial[h],
-                "start":start[h],
-                "end":end[h]
+                "rating":param(rating, h),
+                "capacity":float(param(capacity, h)),
+                "initial":param(initial, h),
+                "start":param(start, h),
+                "end":param(end, h)
                 }
         else:
             home_params[h]["EV"] = {}
     return home_params
 
-def combine_result(P_res, P_ev, SOC, ev_homes, diff=None):
+class HomeSchedule(Mapping):
+    """
+    Hourly schedules of a set of residences stored as a 2D array with one 
+    row per residence. Rows are accessed by the residence ID as in a 
+    dictionary of schedules.
+    
+    Attributes:
+        homes: list of residence IDs in row order
+        index: dictionary mapping residence ID to row index
+        data: numpy array of shape (number of residences, T)
+    """
+    def __init__(self, homes, T):
+        self.homes = list(homes)
+        self.index = {h:i for i,h in enumerate(self.homes)}
+        self.data = np.zeros(shape=(len(self.homes), T))
+        return
     
-    data = ""
+    def __getitem__(self, h):
+        return self.data[self.index[h]]
     
+    def __setitem__(self, h, value):
+        self.data[self.index[h]] = value
+        return
+    
+    def __iter__(self):
+        return iter(self.homes)
+    
+    def __len__(self):
+        return len(self.homes)
+    
+    def rows(self, homes):
+        return self.data[[self.index[h] for h in homes]]
+
+
+def _profile_rows(profile, homes):
+    # rows of a schedule matrix are taken without per element lookup
+    if isinstance(profile, HomeSchedule):
+        return profile.rows(homes).tolist()
+    return (profile[h] for h in homes)
+
+def _write_section(file_handle, title, homes, rows):
     # Insert separator
-    data += "\n#############################################"
-    data += "\nResidence Usage Profile"
-    data += "\n#############################################\n"
+    file_handle.write("\n#############################################")
+    file_handle.write(f"\n{title}")
+    file_handle.write("\n#############################################\n")
+    
+    # Insert profile rows separated by newlines
+    for i, (h, row) in enumerate(zip(homes, rows)):
+        if i:
+            file_handle.write("\n")
+        file_handle.write(str(h) + ":\t"+' '.join([str(y) for y in row]))
+    return
+
+def _convergence(diff, homes):
+    # convergence of each residence (rows) over ADMM iterations (columns)
+    return [[diff[k+1][h] for k in range(len(diff))] for h in homes]
+
+def combine_result_stream(P_res, P_ev, SOC, ev_homes, file_handle, diff=None):
+    
     # Insert Residence usage profile
-    res_data = '\n'.join([str(h) + ":\t"+' '.join([str(y) for y in P_res[h]]) \
-                          for h in P_res])
-    data += res_data
+    homes = list(P_res)
+    _write_section(file_handle, "Residence Usage Profile", 
+                   homes, _profile_rows(P_res, homes))
     
-    # Insert separator
-    data += "\n#############################################"
-    data += "\nEV Charger Usage Profile"
-    data += "\n#############################################\n"
     # Insert EV charger usage profile
-    ev_data = '\n'.join([str(h) + ":\t"+' '.join([str(z) for z in P_ev[h]]) \
-                         for h in ev_homes])
-    data += ev_data
+    _write_section(file_handle, "EV Charger Usage Profile", 
+                   ev_homes, _profile_rows(P_ev, ev_homes))
     
-    # Insert separator
-    data += "\n#############################################"
-    data += "\nEV Charger State of Charge Profile"
-    data += "\n#############################################\n"
     # Insert EV charger SOC profile
-    soc_data = '\n'.join([str(h) + ":\t"+' '.join([str(z) for z in SOC[h]]) \
-                          for h in ev_homes])
-    data += soc_data
+    _write_section(file_handle, "EV Charger State of Charge Profile", 
+                   ev_homes, _profile_rows(SOC, ev_homes))
     
     if diff:
-    # insert separator
-        data += "\n#############################################"
-        data += "\nEV Convergence over Iterations"
-        data += "\n#############################################\n"
         # Insert convergence result
-        diff_data = '\n'.join([str(h) + ":\t"+' '.join([str(diff[k+1][h]) \
-                                                        for k in range(len(diff))]) \
-                               for h in ev_homes])
-        data += diff_data
-    return data
\ No newline at end of file
+        _write_section(file_handle, "EV Convergence over Iterations", 
+                       ev_homes, _convergence(diff, ev_homes))
+    return
+
+def combine_result(P_res, P_ev, SOC, ev_homes, diff=None):
+    data = io.StringIO()
+    combine_result_stream(P_res, P_ev, SOC, ev_homes, data, diff)
+    return data.getvalue()
+
+def results_to_structured(P_res, P_ev, SOC, ev_homes):
+    """
+    Pack the residence, EV charger and state of charge profiles into a 
+    structured array with one record per residence. The field ev_rank is 
+    the position of the residence in ev_homes (-1 for residences without 
+    EV) so that EV profiles are saved in the order of ev_homes.
+    """
+    homes = list(P_res)
+    T = len(P_res[homes[0]])
+    ev_rank = {h:i for i,h in enumerate(ev_homes)} \
+        if ev_homes is not None else {}
+    
+    dtype = [('home', 'i8'), ('Pres', 'f8', T), ('Pev', 'f8', T), 
+             ('soc', 'f8', T+1), ('is_ev', '?'), ('ev_rank', 'i8')]
+    records = np.zeros(len(homes), dtype=dtype)
+    records['home'] = homes
+    for field, profile in (('Pres', P_res), ('Pev', P_ev), ('soc', SOC)):
+        if isinstance(profile, HomeSchedule):
+            records[field] = profile.rows(homes)
+        else:
+            records[field] = [profile[h] for h in homes]
+    records['is_ev'] = [h in ev_rank for h in homes]
+    records['ev_rank'] = [ev_rank.get(h, -1) for h in homes]
+    return records
+
+def _ev_records(records):
+    # records of residences with EV in the order of ev_homes
+    ev = records[records['is_ev']]
+    return ev[np.argsort(ev['ev_rank'], kind='stable')]
+
+def save_result_npz(path, records, diff=None):
+    ev = _ev_records(records)
+    arrays = dict(
+        home = records['home'], 
+        Pres = records['Pres'], 
+        Pev = records['Pev'], 
+        soc = records['soc'], 
+        ev_homes = ev['home']
+        )
+    if diff:
+        arrays["diff"] = np.array(_convergence(diff, ev['home'])).reshape(
+            len(ev), len(diff))
+    np.savez_compressed(path, **arrays)
+    return
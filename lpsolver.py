@@ -8,12 +8,33 @@ Description: Classes and methods to schedule EV charging at residential premises
 with and without assuring network reliability
 """
 
+import os
 import sys
+import hashlib
+import functools
+import threading
 import gurobipy as grb
 import numpy as np
 import networkx as nx
 from tqdm import tqdm
 
+# Gurobi environments local to each worker thread
+_thread_data = threading.local()
+
+def get_thread_env():
+    # create the environment once per thread and reuse it for every 
+    # residence solved by that thread
+    if not hasattr(_thread_data, "env"):
+        env = grb.Env(empty=True)
+        env.setParam('OutputFlag', 0)
+        env.start()
+        _thread_data.env = env
+    return _thread_data.env
+
+def progress_kwargs(total):
+    # redraw a progress bar over total items at most about a hundred times
+    return dict(mininterval = 0.5, miniters = max(1, total // 100))
+
 def compute_Rmat(graph):
     A = nx.incidence_matrix(graph,nodelist=list(graph.nodes()),
                             edgelist=list(graph.edges()),oriented=True).toarray()
@@ -42,7 +63,7 @@ def mycallback(model, where):
 
 
 class Home:
-    def __init__(self,cost,homedata,p_est,p_sch,gamma,kappa = 5.0):
+    def __init__(self,cost,homedata,p_est,p_sch,gamma,kappa = 5.0,env = None):
         self.c = cost
         self.T = len(cost)
         self.data = homedata
@@ -50,7 +71,7 @@ class Home:
         self.g = {}
         self.s = {}
         
-        self.model = grb.Model(name="Get Optimal Schedule")
+        self.model = grb.Model(name="Get Optimal Schedule", env=env)
         self.model.ModelSense = grb.GRB.MINIMIZE
         self.add_EV()
         self.netload_var()
@@ -128,13 +149,15 @@ class Home:
         self.model.setObjective(obj)
         return
     
-    def solve(self,grbpath):
+    def solve(self,grbpath,threads=None,callback=mycallback):
         # Write the LP problem
         self.model.write(f"{grbpath}/ev-schedule-agent.lp")
         
         # Set up solver settings
-        grb.setParam('OutputFlag', 0)
-        grb.setParam('Heuristics', 0)
+        self.model.setParam('OutputFlag', 0)
+        self.model.setParam('Heuristics', 0)
+        if threads:
+            self.model.setParam('Threads', threads)
         
         # Open log file
         logfile = open(f"{grbpath}/gurobi-ev-agent.log", 'w')
@@ -146,7 +169,7 @@ class Home:
         self.model._vars = self.model.getVars()
         
         # Solve model and capture solution information
-        self.model.optimize(mycallback)
+        self.model.optimize(callback)
         
         # Close log file
         logfile.close()
@@ -162,13 +185,14 @@ class Home:
 
 class Utility:
     def __init__(self,graph,P_util,P_sch,Gamma,
-                 kappa=5.0,vset=1.0,low=0.95,high=1.05):
+                 kappa=5.0,vset=1.0,low=0.95,high=1.05,env=None):
         self.nodes = [n for n in graph.nodes if graph.nodes[n]['label'] != 'S']
         self.res = [n for n in graph if graph.nodes[n]['label'] == 'H']
         self.N = len(self.nodes)
         self.T = len(Gamma[self.res[0]])
         
-        self.model = grb.Model(name="Get Optimal Utility Estimated Schedule")
+        self.model = grb.Model(name="Get Optimal Utility Estimated Schedule",
+                               env=env)
         self.model.ModelSense = grb.GRB.MINIMIZE
         self.variables()
         self.network(graph,vset=vset,vmin=low,vmax=high)
@@ -207,13 +231,15 @@ class Utility:
         self.model.setObjective(obj1+obj2)
         return
     
-    def solve(self,grbpath):
+    def solve(self,grbpath,threads=None,callback=mycallback):
         # Write the LP problem
         self.model.write(f"{grbpath}/load-schedule-utility.lp")
         
         # Set up solver settings
-        grb.setParam('OutputFlag', 0)
-        grb.setParam('Heuristics', 0)
+        self.model.setParam('OutputFlag', 0)
+        self.model.setParam('Heuristics', 0)
+        if threads:
+            self.model.setParam('Threads', threads)
         
         # Open log file
         logfile = open(f"{grbpath}/gurobi-utility.log", 'w')
@@ -225,7 +251,7 @@ class Utility:
         self.model._vars = self.model.getVars()
         
         # Solve model and capture solution information
-        self.model.optimize(mycallback)
+        self.model.optimize(callback)
         
         # Close log file
         logfile.close()
@@ -240,38 +266,46 @@ class Utility:
 
 #%% Iterative ADMM for distributed optimization
 def solve_ADMM(homes,graph,cost,grbpath,
-               kappa=5.0,iter_max=15,vset=1.0,vlow=0.95,vhigh=1.05):
-    P_est = {0:{h:np.array([0]*len(cost)) for h in homes}}
-    P_sch = {0:{h:np.array([0]*len(cost)) for h in homes}}
-    G = {0:{h:np.array([0]*len(cost)) for h in homes}}
+               kappa=5.0,iter_max=15,vset=1.0,vlow=0.95,vhigh=1.05,
+               warm_state=None,threads=None,env=None,tol=None,
+               callback=mycallback):
+    # Initial iterates: zero (cold start) or the final iterates of an 
+    # earlier ADMM run (warm start)
+    if not warm_state:
+        warm_state = {"P_est":{}, "P_sch":{}, "G":{}}
+    zero = np.array([0]*len(cost))
+    P_est = {0:{h:np.array(warm_state["P_est"].get(h,zero)) for h in homes}}
+    P_sch = {0:{h:np.array(warm_state["P_sch"].get(h,zero)) for h in homes}}
+    G = {0:{h:np.array(warm_state["G"].get(h,zero)) for h in homes}}
     S = {}
     C = {}
     
     diff = {}
     
-    # ADMM iterations 
+    # ADMM iterations: at most iter_max, fewer if the schedules of all
+    # residences are within the tolerance of the utility estimates
     k = 0 # Iteration count
     while(k < iter_max):
         # solve utility level problem to get estimate
         U_obj = Utility(graph,P_est[k],P_sch[k],G[k],
-                        kappa=kappa,vset=vset,low=vlow,high=vhigh)
-        U_obj.solve(grbpath)
+                        kappa=kappa,vset=vset,low=vlow,high=vhigh,env=env)
+        U_obj.solve(grbpath,threads=threads,callback=callback)
         P_est[k+1] = U_obj.g_opt
         
         
         # solve individual agent level problem
-        homelist = [h for h in homes]
         P_sch[k+1] = {}
         S[k+1] = {}
         C[k+1] = {}
         G[k+1] = {}
         diff[k+1] = {}
-        for i in tqdm(range(len(homelist)), 
-                      desc=f"Iteration {k+1}: Solving home schedule"):
+        for h in tqdm(homes, 
+                      desc=f"Iteration {k+1}: Solving home schedule",
+                      **progress_kwargs(len(homes))):
             # solve each individual residence
-            h = homelist[i]
-            H_obj = Home(cost,homes[h],P_est[k][h],P_sch[k][h],G[k][h],kappa=kappa)
-            H_obj.solve(grbpath)
+            H_obj = Home(cost,homes[h],P_est[k][h],P_sch[k][h],G[k][h],
+                         kappa=kappa,env=env)
+            H_obj.solve(grbpath,threads=threads,callback=callback)
             P_sch[k+1][h] = H_obj.g_opt
             S[k+1][h] = H_obj.p_opt
             C[k+1][h] = H_obj.s_opt
@@ -285,20 +319,39 @@ def solve_ADMM(homes,graph,cost,grbpath,
         
         
         k = k + 1 # Increment iteration
+        if tol is not None and max(diff[k].values()) < tol:
+            break
+    
+    # Final primal and dual iterates to warm start a later run
+    state = {"P_est":P_est[k], "P_sch":P_sch[k], "G":G[k]}
     
     # Return results 
-    return diff, P_sch[k],S[k],C[k]
+    return diff, P_sch[k],S[k],C[k],state
 
 
 #%% Individual Residence and Centralized Problems
 
-def setup_solve(model, path, location):
+def input_hash(*inputs):
+    # name of the cached solver start file for a set of problem inputs
+    return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+def setup_solve(model, path, location, threads=None, start_file=None, 
+                callback=mycallback):
     # Write the LP problem
     model.write(f"{path}/ev-schedule-{location}.lp")
     
+    # Start from the solution of an identical earlier problem: MIP start 
+    # for mixed integer problems and simplex basis otherwise
+    if start_file:
+        start_file = f"{start_file}.{'mst' if model.IsMIP else 'bas'}"
+        if os.path.exists(start_file):
+            model.read(start_file)
+    
     # Set up solver settings
-    grb.setParam('OutputFlag', 0)
-    grb.setParam('Heuristics', 0)
+    model.setParam('OutputFlag', 0)
+    model.setParam('Heuristics', 0)
+    if threads:
+        model.setParam('Threads', threads)
     
     # Open log file
     logfile = open(f"{path}/gurobi-ev-{location}.log", 'w')
@@ -310,10 +363,18 @@ def setup_solve(model, path, location):
     model._vars = model.getVars()
     
     # Solve model and capture solution information
-    model.optimize(mycallback)
+    model.optimize(callback)
     
     # Close log file
     logfile.close()
+    
+    # Save the start for later runs; written under a temporary name first 
+    # so that parallel workers never read a partial file
+    if start_file and model.SolCount > 0:
+        stem, ext = os.path.splitext(start_file)
+        tmp_file = f"{stem}-{os.getpid()}-{threading.get_native_id()}{ext}"
+        model.write(tmp_file)
+        os.replace(tmp_file, start_file)
     return
 
 def add_home_noEV(model, T, home_index = 0):
@@ -427,9 +488,9 @@ def objective_centralized(model, tariff, demand):
             sum(b[j] * a @ demand[:, j] for j in range(T)))
     return
 
-def solve_residence(tariff, data, path):
+def build_residence(tariff, data, env=None):
     # initialize model
-    model = grb.Model(name = "Get Individual Optimal Schedule")
+    model = grb.Model(name = "Get Individual Optimal Schedule", env = env)
     model.ModelSense = grb.GRB.MINIMIZE
     
     # size of variables
@@ -437,7 +498,7 @@ def solve_residence(tariff, data, path):
     
     # add variables and constraints
     if data["EV"] == {}:
-        p, s = add_home_noEV(model, T)  
+        p, s = add_home_noEV(model, T)
     else:
         p, s, e = add_home_EV(model, T, **data["EV"])
     
@@ -446,9 +507,80 @@ def solve_residence(tariff, data, path):
     
     # objective function
     objective_individual_home(model, tariff, g, s, T)
+    return model, p, s, g
+
+def _solve_residence_ev_lp(tariff, load, rating, capacity, initial, start, end):
+    """
+    Individual residence problem with an EV solved without a solver. The 
+    state of charge only grows, so its upper limit bounds the number of 
+    charging hours, and the objective is separable over the hours: the 
+    cheapest allowed hours are charged as long as a charged hour lowers 
+    the objective.
+    """
+    T = tariff.shape[0]
+    p = np.zeros(T)
+    s = np.zeros(T+1)
+    
+    # largest number of charging hours
+    step = rating / capacity
+    n_max = int(np.floor((1.0 - initial) / step + 1e-9))
+    feasible = n_max >= 0
+    
+    # hours when charging is allowed, cheapest first
+    hours = np.arange(T)
+    hours = hours[(hours >= start) & (hours < end)]
+    
+    if feasible:
+        order = hours[np.argsort(tariff[hours], kind='mergesort')]
+        count = 0
+        for t in order:
+            gain = (0.99 / capacity) - (0.01 * tariff[t])
+            if (count < n_max) and (gain > 0):
+                p[t] = rating
+                count += 1
+    
+    # soc evolution
+    s[0] = initial
+    for t in range(T):
+        s[t+1] = s[t] + (p[t] / capacity)
+    return p, s, load + p, feasible
+
+@functools.lru_cache(maxsize=None)
+def _compiled_residence_ev_lp():
+    # numba is only needed by the individual optimizer: it is imported and
+    # the kernel compiled (or loaded from the cache) on first use
+    from numba import njit
+    return njit(cache=True, fastmath=True)(_solve_residence_ev_lp)
+
+def solve_residence_fast(tariff, data):
+    # solution of the individual residence problem without gurobi; None if
+    # the problem does not match the structure of _solve_residence_ev_lp
+    T = len(tariff)
+    load = np.array(data["LOAD"], dtype=float)
+    if data["EV"] == {}:
+        return np.zeros(T), np.zeros(T+1), load
+    
+    ev = data["EV"]
+    if set(ev) != {"rating", "capacity", "initial", "start", "end"}:
+        return None
+    p, s, g, feasible = _compiled_residence_ev_lp()(
+        np.array(tariff, dtype=float), load, 
+        float(ev["rating"]), float(ev["capacity"]), float(ev["initial"]), 
+        float(ev["start"]), float(ev["end"]))
+    if not feasible:
+        return None
+    return p, s, g
+
+def solve_residence(tariff, data, path, env=None, basis_dir=None, 
+                    callback=mycallback):
+    model, p, s, g = build_residence(tariff, data, env)
     
     # Solve the problem
-    setup_solve(model, path, "agent")
+    start_file = None
+    if basis_dir:
+        start_file = f"{basis_dir}/agent-{input_hash(tariff, data)}"
+    setup_solve(model, path, "agent", start_file=start_file, 
+                callback=callback)
     
     if model.SolCount == 0:
         print(f"No solution found, optimization status = {model.Status}")
@@ -460,9 +592,18 @@ def solve_residence(tariff, data, path):
         return p_opt, s_opt, g_opt
     
     
-def solve_central(tariff, homes, dist, path, vset, vmin, vmax):
+def set_start(var, values):
+    # initial solution and hint for the branch and bound
+    values = np.asarray(values, dtype=float)
+    var.setAttr("Start", values)
+    var.setAttr("VarHintVal", values)
+    return
+
+def solve_central(tariff, homes, dist, path, vset, vmin, vmax, 
+                  warm=None, threads=None, basis_dir=None, env=None, 
+                  callback=mycallback):
     # initialize model
-    model = grb.Model(name = "Get Central Optimal Schedule")
+    model = grb.Model(name = "Get Central Optimal Schedule", env = env)
     model.ModelSense = grb.GRB.MINIMIZE
     
     # size of variables
@@ -486,11 +627,29 @@ def solve_central(tariff, homes, dist, path, vset, vmin, vmax):
     
         add_home_load(model, T, g[i,:], homes[h]["LOAD"], p[h])
     
+    # warm start with a schedule (e.g. individual optimal schedule)
+    if warm:
+        p_init, s_init, g_init = warm
+        for i,h in enumerate(res):
+            set_start(p[h], p_init[h])
+            set_start(s[h], s_init[h])
+            set_start(g[i,:], g_init[h])
+            if h in e:
+                prate = homes[h]["EV"]["rating"]
+                set_start(e[h], np.round(np.asarray(p_init[h]) / prate))
+    
     # objective function
     objective_centralized(model, tariff, g)
     
     # Solve the problem
-    setup_solve(model, path, "central")
+    start_file = None
+    if basis_dir:
+        key = input_hash(tariff, [homes[h] for h in res], res, 
+                         [dist.edges[e]['r'] for e in dist.edges], 
+                         vset, vmin, vmax)
+        start_file = f"{basis_dir}/central-{key}"
+    setup_solve(model, path, "central", threads=threads, start_file=start_file, 
+                callback=callback)
     
     if model.SolCount == 0:
         print(f"No solution found, optimization status = {model.Status}")
@@ -13,20 +13,83 @@ warnings.filterwarnings("ignore")
 
 
 import os
+import sys
+import functools
+import threading
 import unittest
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
+import networkx as nx
+from pathlib import Path
+from types import MappingProxyType
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
+from joblib import Parallel, delayed
 
 from extract import GetTariff, GetHomeLoad, GetDistNet, GetCommunity, get_homes_ev_param
-from extract import combine_result
-from lpsolver import solve_residence, solve_ADMM, solve_central
-from drawing import boxplot_flow, boxplot_volt
+from extract import HomeSchedule
+from extract import combine_result_stream, results_to_structured, save_result_npz
+from lpsolver import solve_residence, solve_ADMM, solve_central, get_thread_env
+from lpsolver import solve_residence_fast, progress_kwargs, mycallback
 
 
 
+@functools.lru_cache(maxsize=256)
+def _ensure_dir(path):
+    # create the directory once per process; safe with parallel workers
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+# Cached input readers: parameter sweeps read the same files repeatedly.
+# No caller modifies the inputs, so the cached data is shared: small lists 
+# are copied, the home loads are a read-only view of tuples and the network 
+# is frozen.
+@functools.lru_cache(maxsize=32)
+def _cached_tariff(data_path, tariffID, shift):
+    return GetTariff(data_path, tariffID, shift)
+
+@functools.lru_cache(maxsize=32)
+def _cached_homes(data_path, regionID, shift):
+    if isinstance(regionID, tuple):
+        regionID = list(regionID)
+    homes = GetHomeLoad(data_path, regionID, shift=shift)
+    return {h:tuple(load) for h, load in homes.items()}
+
+@functools.lru_cache(maxsize=32)
+def _cached_network(data_path, networkID):
+    if isinstance(networkID, tuple):
+        networkID = list(networkID)
+    return nx.freeze(GetDistNet(data_path, networkID))
+
+@functools.lru_cache(maxsize=32)
+def _cached_community(data_path, networkID, com_index):
+    filename = f"{data_path}/{networkID}-com.txt"
+    return GetCommunity(filename, com_index)
+
+
+def _profile_key(home, tariff):
+    # the load only adds a constant to the residence objective, so 
+    # residences with the same tariff and EV parameters have the same 
+    # optimal EV schedule
+    return (tuple(tariff), tuple(sorted(home["EV"].items())))
+
+
+def _solve_home(h, tariff, home, grb_dir, basis_dir=None, callback=mycallback):
+    # each worker writes its gurobi files to its own subdirectory
+    worker_dir = f"{grb_dir}/w{os.getpid()}-{threading.get_native_id()}"
+    _ensure_dir(worker_dir)
+    p_opt, s_opt, g_opt = solve_residence(
+        tariff, home, worker_dir, 
+        env = get_thread_env(), basis_dir = basis_dir, callback = callback)
+    return h, p_opt, s_opt, g_opt
+
+
 def get_fig_from_ax(ax, **kwargs):
+    import matplotlib
+    import matplotlib.pyplot as plt
+    
     if not ax:
         no_ax = True
         ndim = kwargs.get('ndim', (1, 1))
@@ -49,6 +112,8 @@ def get_fig_from_ax(ax, **kwargs):
 
 
 def close_fig(fig, to_file=None, show=True, **kwargs):
+    import matplotlib.pyplot as plt
+    
     if to_file:
         fig.savefig(to_file, **kwargs)
     if show:
@@ -66,14 +131,29 @@ class REVS:
         self.optim     = kwargs.get("optimizer_mode", "individual")
         
         self.data_path = kwargs.get("data_path")
-        out_path = kwargs.get("out_path")
-        grb_path = kwargs.get("grb_path")
-        self.out_dir   = f"{out_path}/{self.netID}-com{self.com}/{self.optim}"
-        self.grb_dir   = f"{grb_path}/{self.netID}-com{self.com}/{self.optim}"
+        self.out_path  = kwargs.get("out_path")
+        self.grb_path  = kwargs.get("grb_path")
+        self.out_dir, self.grb_dir = self.mode_dirs(self.optim)
         self.fig_dir   = kwargs.get("fig_path")
         
+        # solver start files shared by all optimizer modes and runs
+        self.basis_cache_dir = kwargs.get(
+            "basis_cache_path", 
+            Path(f"{self.grb_path}") / f"{self.netID}-com{self.com}" / "shared")
+        if self.basis_cache_dir:
+            self.basis_cache_dir = _ensure_dir(self.basis_cache_dir)
+        
+        # ADMM iterates from earlier distributed runs for warm start
+        self._admm_warm = {}
         pass
     
+    # Output and gurobi directories of an optimizer mode
+    def mode_dirs(self, optim):
+        com_dir = f"{self.netID}-com{self.com}"
+        out_dir = Path(f"{self.out_path}") / com_dir / optim
+        grb_dir = Path(f"{self.grb_path}") / com_dir / optim
+        return _ensure_dir(out_dir), _ensure_dir(grb_dir)
+    
     # Out directory setter/ if not, create a directory
     @property
     def out_dir(self):
@@ -81,9 +161,9 @@ class REVS:
 
     @out_dir.setter
     def out_dir(self, out):
-        self._out_dir = out
-        if not os.path.exists(self.out_dir):
-            os.makedirs(self.out_dir)
+        self._out_dir = _ensure_dir(out)
+        self._save_path_template = \
+            self._out_dir / "adopt{adopt}-rating{rating}-seed{seed}.txt"
         pass
     
     # Figures directory setter/ if not, create a directory
@@ -93,9 +173,7 @@ class REVS:
 
     @fig_dir.setter
     def fig_dir(self, fig):
-        self._fig_dir = fig
-        if not os.path.exists(self.fig_dir):
-            os.makedirs(self.fig_dir)
+        self._fig_dir = _ensure_dir(fig)
         pass
     
     # Gurobi directory setter/ if not, create a directory
@@ -105,34 +183,57 @@ class REVS:
 
     @grb_dir.setter
     def grb_dir(self, grb):
-        self._grb_dir = grb
-        if not os.path.exists(self.grb_dir):
-            os.makedirs(self.grb_dir)
+        self._grb_dir = _ensure_dir(grb)
         pass
     
     
+    # path of the result file for a run in the output directory
+    def save_path(self, out_dir=None, **params):
+        template = self._save_path_template
+        if out_dir:
+            template = Path(out_dir) / template.name
+        return template.with_name(template.name.format(**params))
+    
+    # write the schedules to a result file: compressed numpy arrays or 
+    # text written as they are formatted
+    def write_result(self, path, Pres, Pev, soc, ev_homes, diff=None, 
+                     save_format="txt"):
+        if save_format == "npz":
+            records = results_to_structured(Pres, Pev, soc, ev_homes)
+            save_result_npz(Path(path).with_suffix(".npz"), records, diff)
+        elif save_format == "txt":
+            with open(path, "w", buffering=1<<20) as f:
+                combine_result_stream(Pres, Pev, soc, ev_homes, f, diff)
+        else:
+            raise ValueError(f"{save_format} is not a valid save format!")
+        pass
+    
     # functions to read input data
     def read_tariff(self, tariffID = None, shift = 6):
         if not tariffID:
             tariffID = "DVP"
             
-        tariff = GetTariff(self.data_path, tariffID, shift)
-        return tariff
+        tariff = _cached_tariff(self.data_path, tariffID, shift)
+        return list(tariff)
     
     def read_homes(self, regionID = None, shift = 6):
         if not regionID:
             regionID = self.regID
+        if isinstance(regionID, list):
+            regionID = tuple(regionID)
         
         # Home load data
-        homes = GetHomeLoad(self.data_path, regionID, shift=shift)
-        return homes
+        homes = _cached_homes(self.data_path, regionID, shift)
+        return MappingProxyType(homes)
     
     def read_network(self, networkID = None):
         if not networkID:
             networkID = self.netID
+        if isinstance(networkID, list):
+            networkID = tuple(networkID)
         
         # Distribution network data
-        dist = GetDistNet(self.data_path, networkID)
+        dist = _cached_network(self.data_path, networkID)
         return dist
     
     def read_community(self, networkID = None, com_index = 2):
@@ -140,9 +241,8 @@ class REVS:
             networkID = self.netID
         
         # Get the community of residences
-        filename = f"{self.data_path}/{networkID}-com.txt"
-        com = GetCommunity(filename, com_index)
-        return com
+        com = _cached_community(self.data_path, networkID, com_index)
+        return list(com)
     
     def read_inputs(
             self, regionID = None, networkID = None, tariffID = None,
@@ -172,9 +272,11 @@ class REVS:
             com_index = self.com
             )
         if not ev_homes:
-            np.random.seed(int(seed))
+            rng = np.random.default_rng(int(seed))
             num_choice = int(adoption * 1e-2 * len(com))
-            ev_homes = np.random.choice(com, num_choice, replace=False)
+            ev_homes = rng.choice(
+                np.asarray(com), size=num_choice, 
+                replace=False, shuffle=False)
         
         # Get the home data with EV charging parameters
         homes = get_homes_ev_param(
@@ -197,34 +299,86 @@ class REVS:
         adopt = kwargs.get("adoption", 90)
         rating = kwargs.get("rating", 4800)
         seed = kwargs.get("seed", None)
+        save_format = kwargs.get("save_format", "txt")
+        num_workers = kwargs.get("num_workers", os.cpu_count())
+        backend = kwargs.get("backend", "process")
+        fast_solver = kwargs.get("fast_solver", True)
+        
+        # Solve the problem: each residence is independent
+        T = len(tariff)
+        Pres = HomeSchedule(homes, T)
+        Pev = HomeSchedule(homes, T)
+        soc = HomeSchedule(homes, T+1)
+        
+        # residences with identical EV parameters are solved only once
+        keys = {h:_profile_key(homes[h], tariff) for h in homes}
+        unique = {}
+        for h in homes:
+            unique.setdefault(keys[h], h)
+        homelist = list(unique.values())
+        
+        # small residence problems are solved directly in this process; 
+        # only the remaining ones are sent to gurobi workers
+        results = []
+        if fast_solver:
+            pending = []
+            for h in homelist:
+                result = solve_residence_fast(tariff, homes[h])
+                if result is None:
+                    pending.append(h)
+                else:
+                    results.append((h,) + result)
+            homelist = pending
         
-        # Solve the problem
-        Pres = {}
-        Pev = {}
-        soc = {}
-        homelist = list(homes.keys())
-        for i in tqdm(range(len(homelist)), desc="Solving home schedule"):
-            h = homelist[i]
-            p_opt, s_opt, g_opt = solve_residence(
-                tariff, homes[h], 
-                f"{self.grb_dir}")
-            Pres[h] = g_opt
+        if homelist and backend == "process":
+            num_workers = num_workers or os.cpu_count()
+            chunksize = max(1, len(homelist) // (4 * num_workers))
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                solved = executor.map(
+                    _solve_home, homelist, repeat(tariff), 
+                    [homes[h] for h in homelist], repeat(f"{self.grb_dir}"),
+                    repeat(self.basis_cache_dir), chunksize = chunksize)
+                results += list(tqdm(
+                    solved, total=len(homelist), 
+                    desc="Solving home schedule",
+                    **progress_kwargs(len(homelist))))
+        elif homelist:
+            # gurobi releases the GIL while optimizing, but a python callback
+            # takes it back on every call. Residence problems finish long 
+            # before the early stop of mycallback applies, so threads solve 
+            # without it. Model building still holds the GIL, so "loky" 
+            # scales better when building dominates the solve time.
+            callback = None if backend == "threading" else mycallback
+            solved = Parallel(n_jobs=num_workers, backend=backend, 
+                               return_as="generator")(
+                delayed(_solve_home)(h, tariff, homes[h], f"{self.grb_dir}", 
+                                     self.basis_cache_dir, callback) 
+                for h in homelist)
+            results += list(tqdm(
+                solved, total=len(homelist), 
+                desc="Solving home schedule",
+                **progress_kwargs(len(homelist))))
+        
+        solved_cache = {keys[h]:(p_opt, s_opt) \
+                        for h, p_opt, s_opt, _ in results}
+        for h in homes:
+            p_opt, s_opt = solved_cache[keys[h]]
+            Pres[h] = np.asarray(p_opt) + np.array(homes[h]["LOAD"])
             Pev[h] = p_opt
             soc[h] = s_opt
         
         # save the results
         if save:
-            data = combine_result(Pres, Pev, soc, ev_homes)
-            filename = f"adopt{adopt}-rating{rating}-seed{seed}.txt"
-            with open(f"{self.out_dir}/{filename}", "w") as f:
-                f.write(data)
+            path = self.save_path(adopt=adopt, rating=rating, seed=seed)
+            self.write_result(path, Pres, Pev, soc, ev_homes, 
+                              save_format = save_format)
             
         return Pres, Pev, soc
     
     
     def get_centralized_optimal(
             self, tariff, homes, dist, 
-            save = False, **kwargs):
+            save = False, warm = None, **kwargs):
         
         vset = kwargs.get("v0", 1.03)
         vmin = kwargs.get("vmin", 0.90)
@@ -233,52 +387,147 @@ class REVS:
         adopt = kwargs.get("adoption", 90)
         rating = kwargs.get("rating", 4800)
         seed = kwargs.get("seed", None)
+        save_format = kwargs.get("save_format", "txt")
+        threads = kwargs.get("threads", None)
+        env = kwargs.get("env", None)
+        callback = kwargs.get("callback", mycallback)
+        out_dir = kwargs.get("out_dir", self.out_dir)
+        grb_dir = kwargs.get("grb_dir", self.grb_dir)
         
         # solve the problem
         Pev, soc, Pres = solve_central(
-            tariff, homes, dist, f"{self.grb_dir}",
-            vset, vmin, vmax)
+            tariff, homes, dist, f"{grb_dir}",
+            vset, vmin, vmax, warm = warm, threads = threads, 
+            basis_dir = self.basis_cache_dir, env = env, callback = callback)
         
         # save the results
         if save:
-            data = combine_result(Pres, Pev, soc, ev_homes)
-            filename = f"adopt{adopt}-rating{rating}-seed{seed}.txt"
-            with open(f"{self.out_dir}/{filename}", "w") as f:
-                f.write(data)
+            path = self.save_path(out_dir, adopt=adopt, rating=rating, 
+                                  seed=seed)
+            self.write_result(path, Pres, Pev, soc, ev_homes, 
+                              save_format = save_format)
             
         return Pres, Pev, soc
     
+    def nearest_admm_state(self, adopt, rating, seed, kappa):
+        # dual variables are only reused with the same ADMM step size
+        keys = [k for k in self._admm_warm if k[3] == kappa]
+        if not keys:
+            return None
+        
+        # closest stored run in adoption, then rating, then seed
+        key = min(keys, 
+                  key = lambda k: (abs(k[0] - adopt), abs(k[1] - rating), 
+                                   k[2] != seed))
+        return self._admm_warm[key]
+    
     def get_distributed_optimal(
             self, tariff, homes, dist, 
-            save = False, **kwargs):
+            save = False, warm_state = None, **kwargs):
         # get keyword arguments
         kappa = kwargs.get("kappa", 5.0)
         iter_max = kwargs.get("max_iterations", 15)
         vset = kwargs.get("v0", 1.03)
         vlow = kwargs.get("vlow", 0.95)
         vhigh = kwargs.get("vhigh", 1.05)
-        
-        # get the schedule from distributed optimization
-        diff, Pres, Pev, soc = solve_ADMM(
-            homes, dist, tariff, 
-            f"{self.grb_dir}",
-            kappa=kappa, iter_max=iter_max,
-            vset=vset, vlow=vlow, vhigh=vhigh
-            )
+        warm_start = kwargs.get("warm_start", False)
+        tolerance = kwargs.get("tolerance", None)
+        threads = kwargs.get("threads", None)
+        env = kwargs.get("env", None)
+        callback = kwargs.get("callback", mycallback)
+        out_dir = kwargs.get("out_dir", self.out_dir)
+        grb_dir = kwargs.get("grb_dir", self.grb_dir)
         
         ev_homes = kwargs.get("ev_homes", None)
         adopt = kwargs.get("adoption", 90)
         rating = kwargs.get("rating", 4800)
         seed = kwargs.get("seed", None)
+        save_format = kwargs.get("save_format", "txt")
+        
+        # warm start from the nearest earlier run if not provided
+        if warm_state is None and warm_start:
+            warm_state = self.nearest_admm_state(adopt, rating, seed, kappa)
+        
+        # get the schedule from distributed optimization
+        diff, Pres, Pev, soc, state = solve_ADMM(
+            homes, dist, tariff, 
+            f"{grb_dir}",
+            kappa=kappa, iter_max=iter_max,
+            vset=vset, vlow=vlow, vhigh=vhigh,
+            warm_state=warm_state, threads=threads, env=env, tol=tolerance,
+            callback=callback
+            )
+        if warm_start:
+            self._admm_warm[(adopt, rating, seed, kappa)] = state
         
         if save:
-            data = combine_result(Pres, Pev, soc, ev_homes, diff)
-            filename = f"adopt{adopt}-rating{rating}-seed{seed}.txt"
-            with open(f"{self.out_dir}/{filename}", "w") as f:
-                f.write(data)
+            path = self.save_path(out_dir, adopt=adopt, rating=rating, 
+                                  seed=seed)
+            self.write_result(path, Pres, Pev, soc, ev_homes, diff, 
+                              save_format = save_format)
         
         return Pres, Pev, soc
     
+    def get_both_optimal(
+            self, tariff, homes, dist, 
+            save = False, **kwargs):
+        # the directories and environments are set for each solve
+        for key in ("out_dir", "grb_dir", "env", "callback"):
+            if key in kwargs:
+                raise ValueError(f"{key} cannot be set for get_both_optimal!")
+        
+        # gurobi threads are split between the two solves
+        kwargs.setdefault("threads", max(1, (os.cpu_count() or 2) // 2))
+        central_out, central_grb = self.mode_dirs("centralized")
+        dist_out, dist_grb = self.mode_dirs("distributed")
+        
+        # each worker thread builds its models in its own gurobi environment
+        def run(method, out_dir, grb_dir, callback):
+            return method(
+                tariff, homes, dist, save = save, 
+                out_dir = out_dir, grb_dir = grb_dir, 
+                env = get_thread_env(), callback = callback, **kwargs)
+        
+        # centralized and distributed optimization run concurrently. The 
+        # python callback takes the GIL back on every call: the ADMM 
+        # problems finish long before its early stop applies, so only the 
+        # centralized solve keeps it.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            central = executor.submit(
+                run, self.get_centralized_optimal, central_out, central_grb, 
+                mycallback)
+            distributed = executor.submit(
+                run, self.get_distributed_optimal, dist_out, dist_grb, None)
+            return central.result(), distributed.result()
+    
+    def get_individual_then_central(
+            self, tariff, homes, dist, 
+            save = False, **kwargs):
+        # individual optimal schedules as initial solution
+        kwargs.pop("warm", None)
+        Pres, Pev, soc = self.get_individual_optimal(
+            tariff, homes, save = False, **kwargs)
+        
+        return self.get_centralized_optimal(
+            tariff, homes, dist, save = save, 
+            warm = (Pev, soc, Pres), **kwargs)
+    
+    def get_individual_then_distributed(
+            self, tariff, homes, dist, 
+            save = False, **kwargs):
+        # the individual schedules replace any other warm start
+        kwargs.pop("warm_state", None)
+        kwargs.pop("warm_start", None)
+        
+        # individual optimal schedules as initial ADMM iterates
+        Pres, Pev, soc = self.get_individual_optimal(
+            tariff, homes, save = False, **kwargs)
+        warm_state = {"P_est":Pres, "P_sch":Pres, "G":{}}
+        
+        return self.get_distributed_optimal(
+            tariff, homes, dist, save = save, 
+            warm_state = warm_state, **kwargs)
+    
     def plot_result(
             self, demand, dist, 
             ax = None, to_file=None, show=True, 
@@ -290,6 +539,14 @@ class REVS:
         fontsize = kwargs.get('fontsize', 30)
         do_return = kwargs.get('do_return', False)
         node_interest = kwargs.get("community", None)
+        
+        # plotting modules are imported only when plots are drawn; the 
+        # non-interactive backend is chosen only when the figure created 
+        # here is just saved to file and pyplot is not in use yet
+        import matplotlib
+        if (not ax) and (not show) and ('matplotlib.pyplot' not in sys.modules):
+            matplotlib.use("Agg")
+        from drawing import boxplot_flow, boxplot_volt
 
         # ---- PLOT ----
         fig, axs, no_ax = get_fig_from_ax(ax, 
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Rounak Meyur
+
+Description: 
+    Checks that the direct solution of the individual residence problem 
+    (solve_residence_fast) attains the same objective as the gurobi 
+    solution (solve_residence) for every residence of the input data, and 
+    that every residence without a direct solution is infeasible
+"""
+
+import sys
+import yaml
+import numpy as np
+from revs_fixture import REVS
+from lpsolver import solve_residence, solve_residence_fast, build_residence
+
+config_file = sys.argv[1]
+with open(config_file) as f:
+    config = yaml.safe_load(f)
+
+file_params = config["run_parameters"]["input_filepath"]
+inp_params = config["run_parameters"]["input_parameters"]
+
+
+def objective(tariff, g, s):
+    # objective of the individual residence problem
+    return (0.01 * np.array(tariff) @ np.array(g)) + (0.99 * (1 - s[-1]))
+
+
+# Initialize file and directory paths
+fx = REVS(**file_params)
+
+# Get the inputs for the pipeline
+tariff, homes, dist, save_data = fx.read_inputs(**inp_params)
+
+# Compare the objectives of both solutions
+gap = {}
+missed = []
+for h in homes:
+    result = solve_residence_fast(tariff, homes[h])
+    if result is None:
+        # gurobi must not find a solution either
+        model = build_residence(tariff, homes[h])[0]
+        model.setParam('OutputFlag', 0)
+        model.optimize()
+        if model.SolCount > 0:
+            missed.append(h)
+        continue
+    p_fast, s_fast, g_fast = result
+    p_opt, s_opt, g_opt = solve_residence(
+        tariff, homes[h], f"{fx.grb_dir}")
+    gap[h] = objective(tariff, g_fast, s_fast) - objective(tariff, g_opt, s_opt)
+
+print(f"Compared {len(gap)} of {len(homes)} residences")
+if missed:
+    print(f"Feasible residences without direct solution: {missed}")
+
+# gurobi stops within its MIP gap, so only a direct solution worse than 
+# the gurobi solution is a failure
+worst = None
+if gap:
+    worst = max(gap, key=lambda h: gap[h])
+    print(f"Largest objective gap: {gap[worst]:.3e} (residence {worst})")
+if missed or (worst is not None and gap[worst] > 1e-6):
+    sys.exit(1)